@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 import argparse
+import http.client
 import json
+import os
+import random
 import re
+import threading
 import time
 import urllib.parse
-import urllib.request
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
 
 GUILDS = [
     "Mythic",
@@ -35,80 +47,314 @@ GUILDS = [
     "ManshaSlayers",
 ]
 
+_SEARCH_RE = re.compile(r"[A-Za-z0-9_]{3,16}")
 
-def http_get_json(url: str, timeout: int = 30) -> (int, Optional[dict], str):
-    req = urllib.request.Request(url, method="GET")
-    try:
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            body = resp.read().decode("utf-8")
-            if not body:
-                return resp.status, None, ""
-            return resp.status, json.loads(body), ""
-    except urllib.error.HTTPError as e:
+FAILURE_CACHE_PATH = "prewarm_failures.tsv"
+
+
+_base_path = ""
+_connection_factory = None
+_local = threading.local()
+_head_supported = True
+
+
+def open_connection(base_url: str, timeout: int = 30) -> None:
+    global _base_path, _connection_factory
+    parts = urllib.parse.urlsplit(base_url)
+    conn_cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    _base_path = parts.path.rstrip("/")
+    _connection_factory = lambda: conn_cls(parts.hostname, parts.port, timeout=timeout)
+    reset_connection()
+
+
+def reset_connection() -> None:
+    conn = getattr(_local, "connection", None)
+    if conn is not None:
+        conn.close()
+    _local.connection = None
+
+
+def get_connection() -> http.client.HTTPConnection:
+    conn = getattr(_local, "connection", None)
+    if conn is None:
+        conn = _local.connection = _connection_factory()
+    return conn
+
+
+def http_request(method: str, path: str) -> Tuple[int, bytes, dict]:
+    # Each worker thread keeps its own connection alive between calls; if the
+    # server dropped it while idle, reconnect once before reporting a failure.
+    for attempt in range(2):
+        reused = getattr(_local, "connection", None) is not None
         try:
-            body = e.read().decode("utf-8")
-            return e.code, json.loads(body) if body else None, body
+            conn = get_connection()
+            conn.request(method, path)
+            resp = conn.getresponse()
+            return resp.status, resp.read(), resp.headers
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            reset_connection()
+            if reused and attempt == 0:
+                continue
+            return 0, b"", {}
         except Exception:
-            return e.code, None, ""
-    except Exception:
-        return 0, None, ""
+            reset_connection()
+            return 0, b"", {}
+    return 0, b"", {}
+
+
+def parse_retry_after(status: int, headers) -> Optional[float]:
+    # Prefer a standard Retry-After (seconds or HTTP date). The rate limiter's
+    # X-RateLimit-Reset is on every response, so it only counts for a 429 once
+    # the limiter's window is actually used up; task-cap 429s fall through.
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    exhausted = status == 429 and headers.get("X-RateLimit-Remaining") == "0"
+    reset = headers.get("X-RateLimit-Reset") if exhausted else None
+    if reset:
+        try:
+            return max(0.0, float(reset) - time.time())
+        except ValueError:
+            pass
+    return None
+
+
+def http_head(path: str) -> Tuple[int, Optional[float]]:
+    status, _, resp_headers = http_request("HEAD", path)
+    return status, parse_retry_after(status, resp_headers)
+
+
+def http_get_json(path: str) -> (int, Optional[dict], str, Optional[float]):
+    status, body, resp_headers = http_request("GET", path)
+    retry_after = parse_retry_after(status, resp_headers)
+    # Only the status of an in-progress response matters; its body is still
+    # read so the connection can be reused, but never decoded.
+    if status in (202, 204) or not body:
+        return status, None, "", retry_after
+    raw = body.decode("utf-8", errors="replace") if status >= 400 else ""
+    try:
+        data = _loads(body)
+    except ValueError:
+        return (status, None, raw, retry_after) if status >= 400 else (0, None, "", None)
+    return status, data, raw, retry_after
+
 
+def backoff(base: float, retries: int, server_delay: Optional[float] = None, cap: float = 60.0) -> float:
+    # Exponential unless the server said how long to wait; capped and jittered
+    # either way so parallel workers don't retry in lockstep.
+    wait = base * 2 ** retries if server_delay is None else server_delay
+    return min(cap, wait) + random.uniform(0, base)
 
-def wait_for_200(url: str, label: str, max_attempts: int, delay: float) -> Optional[dict]:
+
+def is_transient_status(status: int) -> bool:
+    # Statuses that may succeed on a later run: still in progress, rate
+    # limited, server errors/maintenance and no connection.
+    return status in (0, 202, 429) or 500 <= status < 600
+
+
+def wait_for_200(
+    path: str,
+    label: str,
+    max_attempts: int,
+    delay: float,
+    want_body: bool = True,
+) -> Tuple[Optional[dict], int]:
+    # Polls with HEAD so retries don't transfer the body. When the body is
+    # wanted, the first try and the one after a ready probe are GETs, so an
+    # already cached target costs one request. Without want_body, success
+    # returns {}. The last status seen is returned alongside the data.
+    global _head_supported
     last_status = 0
+    rate_limited = 0
+    server_errors = 0
+    message = None
     for attempt in range(1, max_attempts + 1):
-        status, data, raw = http_get_json(url)
+        status = None
+        if _head_supported and (attempt > 1 or not want_body):
+            status, retry_after = http_head(path)
+            data = {}
+            raw = ""
+            if status in (405, 501):
+                _head_supported = False
+                status = None
+            elif status == 200 and want_body:
+                status = None
+            elif status != 200 and not is_transient_status(status) and message is None:
+                # A HEAD can't carry the server's message for an unexpected
+                # status; fetch it once, later probes reuse it.
+                status = None
+        if status is None:
+            status, data, raw, retry_after = http_get_json(path)
         last_status = status
         if status == 200:
-            return data
+            return data, status
         if status == 202:
             print(f"[{label}] 202 (in progress) attempt {attempt}/{max_attempts}")
             time.sleep(delay)
             continue
         if status == 429:
             print(f"[{label}] 429 (rate limited) attempt {attempt}/{max_attempts}")
-            time.sleep(max(5.0, delay * 2))
+            time.sleep(backoff(max(5.0, delay * 2), rate_limited, retry_after))
+            rate_limited += 1
+            continue
+        if 500 <= status < 600:
+            print(f"[{label}] {status} (server/backoff) attempt {attempt}/{max_attempts}")
+            time.sleep(backoff(max(10.0, delay * 5), server_errors, retry_after if status == 503 else None))
+            server_errors += 1
             continue
-        if status in (500, 503) or status == 0:
-            code = status if status != 0 else "no connection"
-            print(f"[{label}] {code} (server/backoff) attempt {attempt}/{max_attempts}")
+        if status == 0:
+            print(f"[{label}] no connection (server/backoff) attempt {attempt}/{max_attempts}")
             time.sleep(max(10.0, delay * 5))
             continue
-        msg = raw.strip()
-        extra = f" body={msg}" if msg else ""
+        if message is None:
+            message = raw.strip()
+        extra = f" body={message}" if message else ""
         print(f"[{label}] unexpected status {status}{extra}; retrying ({attempt}/{max_attempts})")
         time.sleep(delay)
     hint = " (connection failed?)" if last_status == 0 else ""
     print(f"[{label}] failed after {max_attempts} attempts{hint}")
-    return None
+    return None, last_status
+
+
+def build_url_prefix(path: str, params: dict, key: str) -> str:
+    # Fixed params are encoded once per run; callers append the quoted value of `key`.
+    return f"{_base_path}{path}?{urllib.parse.urlencode(params)}&{key}="
+
 
+class Throttle:
+    """Spaces target starts at least `interval` seconds apart across all workers."""
 
-def build_url(base_url: str, path: str, params: dict) -> str:
-    return f"{base_url.rstrip('/')}{path}?{urllib.parse.urlencode(params)}"
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.next_allowed = time.monotonic()
+        self.lock = threading.Lock()
 
+    def wait(self) -> None:
+        # Only sleeps when requests are being started faster than the interval,
+        # so slow responses are not followed by an extra fixed delay.
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_allowed)
+            self.next_allowed = start + self.interval
+        if start > now:
+            time.sleep(start - now)
 
-def collect_profile_targets(guild_json: dict) -> List[str]:
+
+def fetch_all(
+    items: List[str],
+    to_path: Callable[[str], str],
+    label: str,
+    args,
+    want_body: bool = True,
+) -> List[Tuple[Optional[dict], int]]:
+    total = len(items)
+    throttle = Throttle(args.throttle)
+
+    def fetch(idx: int, item: str) -> Tuple[Optional[dict], int]:
+        item_label = f"{label}:{idx}/{total}"
+        throttle.wait()
+        print(f"Fetching {item_label}")
+        return wait_for_200(to_path(item), item_label, args.max_attempts, args.delay, want_body)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        return list(pool.map(fetch, range(1, total + 1), items))
+
+
+def load_failure_cache(path: str, ttl: float) -> Dict[Tuple[str, str, str, str], float]:
+    # Lines are "<unix time>\t<host>\t<region>\t<kind>\t<target>"; entries
+    # older than ttl are dropped on load.
+    entries = {}
+    if ttl <= 0:
+        return entries
+    cutoff = time.time() - ttl
+    try:
+        with open(path, encoding="utf-8") as fh:
+            for line in fh:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 5:
+                    continue
+                try:
+                    failed_at = float(parts[0])
+                except ValueError:
+                    continue
+                if failed_at >= cutoff:
+                    entries[tuple(parts[1:])] = failed_at
+    except OSError:
+        pass
+    return entries
+
+
+def save_failure_cache(path: str, entries: Dict[Tuple[str, str, str, str], float]) -> None:
+    lines = [f"{failed_at:.0f}\t" + "\t".join(key) for key, failed_at in entries.items()]
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(("\n".join(lines) + "\n").encode("utf-8") if lines else b"")
+    os.replace(tmp_path, path)
+
+
+def skip_known_failures(
+    items: List[str],
+    failure_cache: Dict[Tuple[str, str, str, str], float],
+    scope: Tuple[str, str, str],
+) -> List[str]:
+    remaining = []
+    for item in items:
+        if (*scope, item) in failure_cache:
+            print(f"[{scope[2]}] {item} cached failure, skipping")
+        else:
+            remaining.append(item)
+    return remaining
+
+
+def record_failures(
+    failure_cache: Dict[Tuple[str, str, str, str], float],
+    scope: Tuple[str, str, str],
+    items: List[str],
+    results: List[Tuple[Optional[dict], int]],
+) -> List[str]:
+    # Every failure is reported, but only definite ones (e.g. 400/404) are
+    # cached; a target that ran out of retries may well succeed next run.
+    now = time.time()
+    failed = []
+    for item, (data, status) in zip(items, results):
+        if data is not None:
+            continue
+        failed.append(item)
+        if not is_transient_status(status):
+            failure_cache[(*scope, item)] = now
+    return failed
+
+
+def save_failures(path: str, failures: List[str]) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(("\n".join(failures) + "\n").encode("utf-8"))
+    os.replace(tmp_path, path)
+
+
+def collect_member_fields(guild_json: dict) -> Tuple[List[str], List[str]]:
     members = guild_json.get("members") or []
     profile_targets = []
+    family_names = []
     for member in members:
         pt = member.get("profileTarget")
         if pt:
             profile_targets.append(pt)
-    return profile_targets
-
-
-def collect_family_names(guild_json: dict) -> List[str]:
-    members = guild_json.get("members") or []
-    family_names = []
-    for member in members:
         fn = member.get("familyName")
         if fn:
             family_names.append(fn)
-    return family_names
+    return profile_targets, family_names
 
 
 def is_valid_search_query(query: str) -> bool:
-    return bool(re.fullmatch(r"[A-Za-z0-9_]{3,16}", query))
+    return _SEARCH_RE.fullmatch(query) is not None
 
 
 def main() -> None:
@@ -117,85 +363,99 @@ def main() -> None:
     parser.add_argument("--region", default="EU", help="Region (default: EU)")
     parser.add_argument("--delay", type=float, default=2.0, help="Delay between retries in seconds")
     parser.add_argument("--max-attempts", type=int, default=20, help="Max retry attempts for 202 responses")
-    parser.add_argument("--throttle", type=float, default=0.2, help="Delay between requests in seconds")
+    parser.add_argument(
+        "--throttle",
+        type=float,
+        default=0.2,
+        help="Minimum interval between starting targets in seconds (retries are paced by --delay)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=5,
+        help="Max requests in flight at once; keep at or below the server's -maxtasksperclient (default 5)",
+    )
+    parser.add_argument(
+        "--failed-ttl",
+        type=float,
+        default=3600,
+        help=f"Skip targets that failed with a non-retryable status (e.g. 404) within this many seconds; "
+        f"kept per host and region in {FAILURE_CACHE_PATH} (0 disables)",
+    )
     parser.add_argument("--warm-search", action="store_true", help="Warm /v1/adventurer/search cache for family names")
     args = parser.parse_args()
 
-    all_profile_targets = []
-    all_family_names = []
+    open_connection(args.base_url)
+    failure_cache = load_failure_cache(FAILURE_CACHE_PATH, args.failed_ttl)
+    cached_failures = len(failure_cache)
+    host = urllib.parse.urlsplit(args.base_url).netloc
 
-    for guild in GUILDS:
-        guild_url = build_url(
-            args.base_url,
-            "/v1/guild",
-            {"guildName": guild, "region": args.region},
-        )
-        print(f"Fetching guild: {guild}")
-        guild_json = wait_for_200(
-            guild_url,
-            f"guild:{guild}",
-            args.max_attempts,
-            args.delay,
-        )
+    # Dicts used as ordered sets, so members of several guilds are only kept once.
+    all_profile_targets = {}
+    all_family_names = {}
+
+    guild_prefix = build_url_prefix("/v1/guild", {"region": args.region}, "guildName")
+    guild_results = fetch_all(
+        GUILDS,
+        lambda guild: guild_prefix + urllib.parse.quote_plus(guild),
+        "guild",
+        args,
+    )
+    for guild, (guild_json, _) in zip(GUILDS, guild_results):
         if not guild_json:
             continue
-        profile_targets = collect_profile_targets(guild_json)
-        family_names = collect_family_names(guild_json)
-        print(f"  members: {len(profile_targets)}")
-        all_profile_targets.extend(profile_targets)
-        all_family_names.extend(family_names)
-        time.sleep(args.throttle)
-
-    unique_profile_targets = list(dict.fromkeys(all_profile_targets))
-    print(f"Total unique profiles: {len(unique_profile_targets)}")
+        profile_targets, family_names = collect_member_fields(guild_json)
+        print(f"  {guild} members: {len(profile_targets)}")
+        all_profile_targets.update(dict.fromkeys(profile_targets))
+        all_family_names.update(dict.fromkeys(family_names))
 
-    failed_profile_targets = []
+    unique_profile_targets = list(all_profile_targets)
+    print(f"Total unique profiles: {len(unique_profile_targets)}")
+    adventurer_scope = (host, args.region, "adventurer")
+    unique_profile_targets = skip_known_failures(unique_profile_targets, failure_cache, adventurer_scope)
 
-    for idx, profile_target in enumerate(unique_profile_targets, 1):
-        adv_url = build_url(
-            args.base_url,
-            "/v1/adventurer",
-            {"profileTarget": profile_target, "region": args.region},
-        )
-        label = f"adventurer:{idx}/{len(unique_profile_targets)}"
-        print(f"Fetching {label}")
-        result = wait_for_200(adv_url, label, args.max_attempts, args.delay)
-        if result is None:
-            failed_profile_targets.append(profile_target)
-        time.sleep(args.throttle)
+    adventurer_prefix = build_url_prefix("/v1/adventurer", {"region": args.region}, "profileTarget")
+    results = fetch_all(
+        unique_profile_targets,
+        lambda pt: adventurer_prefix + urllib.parse.quote_plus(pt),
+        "adventurer",
+        args,
+        want_body=False,
+    )
+    failed_profile_targets = record_failures(failure_cache, adventurer_scope, unique_profile_targets, results)
 
     if failed_profile_targets:
-        with open("failed_profiles.txt", "w", encoding="utf-8") as fh:
-            for pt in failed_profile_targets:
-                fh.write(pt + "\n")
+        save_failures("failed_profiles.txt", failed_profile_targets)
         print(f"Failed profiles: {len(failed_profile_targets)} (saved to failed_profiles.txt)")
 
     if args.warm_search:
-        unique_family_names = list(dict.fromkeys(all_family_names))
+        unique_family_names = [fn for fn in all_family_names if is_valid_search_query(fn)]
         print(f"Total unique family names: {len(unique_family_names)}")
+        search_scope = (host, args.region, "search")
+        unique_family_names = skip_known_failures(unique_family_names, failure_cache, search_scope)
 
-        failed_searches = []
-        for idx, family_name in enumerate(unique_family_names, 1):
-            if not is_valid_search_query(family_name):
-                continue
-            search_url = build_url(
-                args.base_url,
-                "/v1/adventurer/search",
-                {"query": family_name, "searchType": "familyName", "region": args.region},
-            )
-            label = f"search:{idx}/{len(unique_family_names)}"
-            print(f"Fetching {label}")
-            result = wait_for_200(search_url, label, args.max_attempts, args.delay)
-            if result is None:
-                failed_searches.append(family_name)
-            time.sleep(args.throttle)
+        search_prefix = build_url_prefix(
+            "/v1/adventurer/search",
+            {"searchType": "familyName", "region": args.region},
+            "query",
+        )
+        results = fetch_all(
+            unique_family_names,
+            lambda fn: search_prefix + urllib.parse.quote_plus(fn),
+            "search",
+            args,
+            want_body=False,
+        )
+        failed_searches = record_failures(failure_cache, search_scope, unique_family_names, results)
 
         if failed_searches:
-            with open("failed_searches.txt", "w", encoding="utf-8") as fh:
-                for fn in failed_searches:
-                    fh.write(fn + "\n")
+            save_failures("failed_searches.txt", failed_searches)
             print(f"Failed searches: {len(failed_searches)} (saved to failed_searches.txt)")
 
+    # Rewrite only when entries were added; expired ones are pruned then too.
+    if args.failed_ttl > 0 and len(failure_cache) != cached_failures:
+        save_failure_cache(FAILURE_CACHE_PATH, failure_cache)
+
 
 if __name__ == "__main__":
     main()
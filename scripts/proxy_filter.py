@@ -1,28 +1,34 @@
 #!/usr/bin/env python3
 import argparse
+import re
+import ssl
 import sys
-import time
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List
 
+# Loading the CA bundle is the costly part of setting up an HTTPS opener, so
+# every proxy test shares one context instead of building its own.
+_SSL_CONTEXT = ssl.create_default_context()
+
+_BLOCK_PAGE_RE = re.compile(rb"imperva|incapsula|<iframe", re.IGNORECASE)
+
 
 def fetch_proxy_list(url: str) -> List[str]:
     with urllib.request.urlopen(url, timeout=30) as resp:
-        raw = resp.read().decode("utf-8", errors="ignore")
-    lines = [line.strip() for line in raw.splitlines() if line.strip()]
-    return lines
+        lines = (line.strip() for line in resp)
+        return [line.decode("ascii", errors="ignore") for line in lines if line]
 
 
 def test_proxy(proxy: str, test_url: str, timeout: int) -> bool:
     proxy_handler = urllib.request.ProxyHandler({"http": proxy, "https": proxy})
-    opener = urllib.request.build_opener(proxy_handler)
+    opener = urllib.request.build_opener(proxy_handler, urllib.request.HTTPSHandler(context=_SSL_CONTEXT))
     try:
         with opener.open(test_url, timeout=timeout) as resp:
-            body = resp.read(20000).decode("utf-8", errors="ignore")
+            body = resp.read(20000)
             if resp.status != 200:
                 return False
-            lowered = body.lower()
-            if "imperva" in lowered or "incapsula" in lowered or "<iframe" in lowered:
+            if _BLOCK_PAGE_RE.search(body):
                 return False
             return len(body) > 500
     except Exception:
@@ -43,7 +49,7 @@ def main() -> None:
     )
     parser.add_argument("--limit", type=int, default=50, help="Max proxies to test")
     parser.add_argument("--timeout", type=int, default=8, help="Per-proxy timeout in seconds")
-    parser.add_argument("--sleep", type=float, default=0.2, help="Delay between tests in seconds")
+    parser.add_argument("--workers", type=int, default=20, help="Number of proxies to test in parallel")
     parser.add_argument("--out", default="working_proxies.txt", help="Output file")
     args = parser.parse_args()
 
@@ -52,17 +58,18 @@ def main() -> None:
         print("No proxies found.")
         sys.exit(1)
 
-    tested = 0
     working = []
-    for proxy in proxies:
-        if tested >= args.limit:
-            break
-        tested += 1
-        ok = test_proxy(proxy, args.test_url, args.timeout)
-        print(f"{proxy} -> {'OK' if ok else 'FAIL'}")
-        if ok:
-            working.append(proxy)
-        time.sleep(args.sleep)
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(test_proxy, proxy, args.test_url, args.timeout): proxy
+            for proxy in proxies[: args.limit]
+        }
+        for future in as_completed(futures):
+            proxy = futures[future]
+            ok = future.result()
+            print(f"{proxy} -> {'OK' if ok else 'FAIL'}")
+            if ok:
+                working.append(proxy)
 
     if working:
         with open(args.out, "w", encoding="utf-8") as fh: